@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In-memory stand-in for Google Sheets, selected in test.py's
+# init_connection() with REEDY_BACKEND=fake. It implements the subset of
+# gspread the app uses (worksheets, finds, range and batch reads, appends,
+# balance updates and the Drive revision metadata request) and counts every
+# call, so the load test (loadtest.py) and local runs work offline.
+
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter, defaultdict, namedtuple
+from datetime import datetime, timedelta
+
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+AGENT_PASSWORD = "loadtest"
+FIRST_FAKE_ID = 29000000000000
+BRANCHES = ["Nasser", "Suez", "Arbeen", "Farz"]
+COMPANIES = ["نقل", "توزيع", "إنتاج", "أنابيب البترول", "بتروجيت", "بنك مصر", "AXA", "Alico"]
+
+Cell = namedtuple("Cell", ["row", "col", "value"])
+
+_A1_BOUND = re.compile(r"^([A-Z]*)(\d*)$")
+
+def parse_a1_range(a1):
+    """
+    Parses "A2:F5001", "2:5001", "A:A" or "B7" into 1-based inclusive
+    (first_row, first_col, last_row, last_col); open bounds are None.
+    """
+    bounds = []
+    for part in a1.split("!")[-1].split(":"):
+        letters, digits = _A1_BOUND.match(part.strip().upper()).groups()
+        col = None
+        for letter in letters:
+            col = (col or 0) * 26 + ord(letter) - ord("A") + 1
+        bounds.append((int(digits) if digits else None, col))
+    (first_row, first_col), (last_row, last_col) = bounds[0], bounds[-1]
+    return first_row, first_col, last_row, last_col
+
+def numericise(value):
+    """
+    Mimics gspread's numericise: numeric strings come back as int/float.
+    """
+    if isinstance(value, str):
+        text = value.strip()
+        try:
+            return int(text)
+        except ValueError:
+            pass
+        try:
+            return float(text)
+        except ValueError:
+            return value
+    return value
+
+class BackendStats:
+    """
+    Thread-safe counters of backend calls, e.g. {"transactions.get_all_records": 12}.
+    An optional per-call latency simulates the round trip to Google.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self._lock = threading.Lock()
+        self.calls = Counter()
+
+    def record(self, name):
+        with self._lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def reset(self):
+        with self._lock:
+            calls, self.calls = self.calls, Counter()
+        return calls
+
+    def snapshot(self):
+        with self._lock:
+            return Counter(self.calls)
+
+    def write_periodically(self, path, interval=0.5):
+        """
+        Rewrites the counters as JSON to 'path' every 'interval' seconds from
+        a daemon thread, so a process driving the app can read them.
+        """
+        def write():
+            while True:
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(self.snapshot(), f)
+                os.replace(tmp_path, path)
+                time.sleep(interval)
+
+        threading.Thread(target=write, name="fake-stats-writer", daemon=True).start()
+
+class FakeWorksheet:
+    """
+    In-memory worksheet with the subset of the gspread Worksheet API the app uses.
+    Row 1 is the header; values are stored as strings like in Sheets.
+    """
+
+    def __init__(self, spreadsheet, title, header, rows=()):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.id = abs(hash(title)) % 10 ** 9
+        self._rows = [list(header)] + [[str(value) for value in row] for row in rows]
+        self._lock = threading.RLock()
+
+    def _call(self, method):
+        self.spreadsheet.stats.record(f"{self.title}.{method}")
+
+    @property
+    def row_count(self):
+        return len(self._rows)
+
+    def get_all_values(self):
+        self._call("get_all_values")
+        with self._lock:
+            return [list(row) for row in self._rows]
+
+    def get_all_records(self):
+        self._call("get_all_records")
+        with self._lock:
+            header, rows = self._rows[0], self._rows[1:]
+            return [{key: numericise(row[i] if i < len(row) else "") for i, key in enumerate(header)}
+                    for row in rows]
+
+    def row_values(self, row):
+        self._call("row_values")
+        with self._lock:
+            return list(self._rows[row - 1]) if 0 < row <= len(self._rows) else []
+
+    def col_values(self, col):
+        self._call("col_values")
+        with self._lock:
+            return [row[col - 1] if col - 1 < len(row) else "" for row in self._rows]
+
+    def _range_values(self, a1):
+        first_row, first_col, last_row, last_col = parse_a1_range(a1)
+        with self._lock:
+            rows = self._rows[(first_row or 1) - 1:last_row]
+            values = [row[(first_col or 1) - 1:last_col] for row in rows]
+        # Like the Sheets API: trailing blank rows are dropped, rows padded
+        while values and not any(values[-1]):
+            values.pop()
+        width = max((len(row) for row in values), default=0)
+        return [row + [""] * (width - len(row)) for row in values]
+
+    def get_values(self, range_name=None):
+        self._call("get_values")
+        return self._range_values(range_name) if range_name else self.get_all_values()
+
+    def batch_get(self, ranges):
+        self._call("batch_get")
+        return [self._range_values(a1) for a1 in ranges]
+
+    def cell(self, row, col):
+        self._call("cell")
+        with self._lock:
+            values = self._rows[row - 1] if 0 < row <= len(self._rows) else []
+            return Cell(row, col, values[col - 1] if col - 1 < len(values) else "")
+
+    def find(self, query, in_column=None):
+        self._call("find")
+        query = str(query)
+        with self._lock:
+            for row_index, row in enumerate(self._rows, start=1):
+                for col_index, value in enumerate(row, start=1):
+                    if (in_column is None or in_column == col_index) and value == query:
+                        return Cell(row_index, col_index, value)
+        return None
+
+    def append_row(self, values, value_input_option="RAW"):
+        self._call("append_row")
+        row = ["" if value is None else str(value) for value in values]
+        with self._lock:
+            self._rows.append(row)
+            row_number = len(self._rows)
+        self.spreadsheet.touch()
+        self.spreadsheet.on_append(self.title, row)
+        return {"updates": {"updatedRange": f"'{self.title}'!A{row_number}:{chr(ord('A') + len(row) - 1)}{row_number}"}}
+
+    def update_cell(self, row, col, value):
+        self._call("update_cell")
+        with self._lock:
+            while len(self._rows) < row:
+                self._rows.append([])
+            values = self._rows[row - 1]
+            while len(values) < col:
+                values.append("")
+            values[col - 1] = str(value)
+        self.spreadsheet.touch()
+
+class FakeSpreadsheet:
+    """
+    Holds the four worksheets of the 'database' spreadsheet. Appending a
+    transaction updates 'user_balances', like the sheet formulas do.
+    """
+
+    def __init__(self, title, stats):
+        self.title = title
+        self.id = f"fake-{title}"
+        self.stats = stats
+        self.revision = 1
+        self._worksheets = {}
+
+    def add_worksheet(self, title, header, rows=()):
+        self._worksheets[title] = FakeWorksheet(self, title, header, rows)
+        return self._worksheets[title]
+
+    def worksheet(self, title):
+        import gspread
+
+        self.stats.record("spreadsheet.worksheet")
+        if title not in self._worksheets:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return self._worksheets[title]
+
+    def worksheets(self):
+        self.stats.record("spreadsheet.worksheets")
+        return list(self._worksheets.values())
+
+    def values_batch_get(self, ranges):
+        """
+        Reads sheet-qualified ranges ("'transactions'!5:505") in one call,
+        answering like the Sheets API: "values" is left out of empty ranges.
+        """
+        self.stats.record("spreadsheet.values_batch_get")
+        value_ranges = []
+        for a1 in ranges:
+            title = a1.rsplit("!", 1)[0].strip("'").replace("''", "'")
+            values = self._worksheets[title]._range_values(a1)
+            value_ranges.append({"range": a1, "values": values} if values else {"range": a1})
+        return {"spreadsheetId": self.id, "valueRanges": value_ranges}
+
+    def touch(self):
+        self.revision += 1
+
+    def on_append(self, title, row):
+        if title != "transactions" or "user_balances" not in self._worksheets:
+            return
+        user_id, transaction_type, amount = row[1], row[2], float(row[3] or 0)
+        balances = self._worksheets["user_balances"]
+        with balances._lock:
+            for values in balances._rows[1:]:
+                if values[0] == user_id:
+                    current = float(values[1] or 0)
+                    values[1] = str(current + amount if transaction_type == "ADD" else current - amount)
+                    return
+            balances._rows.append([user_id, str(amount if transaction_type == "ADD" else -amount)])
+
+class FakeResponse:
+    def __init__(self, payload):
+        self._payload = payload
+
+    def json(self):
+        return self._payload
+
+class FakeClient:
+    """
+    Stand-in for an authorized gspread client, including the Drive
+    metadata request used for conditional reloads.
+    """
+
+    def __init__(self, spreadsheets, stats):
+        self._spreadsheets = {sh.title: sh for sh in spreadsheets}
+        self.stats = stats
+
+    def open(self, title):
+        import gspread
+
+        self.stats.record("client.open")
+        if title not in self._spreadsheets:
+            raise gspread.exceptions.SpreadsheetNotFound(title)
+        return self._spreadsheets[title]
+
+    def request(self, method, url, params=None, **kwargs):
+        self.stats.record("drive.metadata")
+        spreadsheet_id = url.rstrip("/").rsplit("/", 1)[-1]
+        for sh in self._spreadsheets.values():
+            if sh.id == spreadsheet_id:
+                return FakeResponse({"modifiedTime": str(sh.revision), "version": str(sh.revision)})
+        return FakeResponse({})
+
+def fake_account_ids(accounts):
+    """
+    IDs of the accounts seed_database creates, in order.
+    """
+    return [str(FIRST_FAKE_ID + i) for i in range(accounts)]
+
+def seed_database(stats, accounts=2000, transactions=20000, agents=50, seed=7):
+    """
+    Builds a fake 'database' spreadsheet with random accounts, transactions
+    and agents (agent1..agentN, password AGENT_PASSWORD).
+    """
+    rng = random.Random(seed)
+    sh = FakeSpreadsheet("database", stats)
+    start = datetime.now() - timedelta(days=365)
+
+    ids = fake_account_ids(accounts)
+    account_rows = [
+        [user_id, f"Customer {i}", rng.choice(COMPANIES), f"agent{rng.randint(1, agents)}",
+         (start + timedelta(minutes=i)).strftime(TIMESTAMP_FORMAT), str(rng.random() < 0.2),
+         f"010{rng.randint(10000000, 99999999)}", f"agent{rng.randint(1, agents)}", rng.choice(BRANCHES)]
+        for i, user_id in enumerate(ids)
+    ]
+    sh.add_worksheet("accounts", ["ID", "Name", "Company", "CreatorAgent", "Timestamp",
+                                  "CanHaveNegativeBalance", "PhoneNumber", "RegisteredBy", "Branch"],
+                     account_rows)
+
+    balances = defaultdict(float)
+    transaction_rows = []
+    step = timedelta(days=365) / max(transactions, 1)
+    for i in range(transactions):
+        user_id = rng.choice(ids)
+        transaction_type = "ADD" if rng.random() < 0.6 else "DEDUCT"
+        amount = float(rng.randint(1, 500))
+        balances[user_id] += amount if transaction_type == "ADD" else -amount
+        transaction_rows.append([(start + step * i).strftime(TIMESTAMP_FORMAT), user_id, transaction_type,
+                                 amount, rng.choice(BRANCHES), f"agent{rng.randint(1, agents)}", ""])
+    sh.add_worksheet("transactions", ["Timestamp", "ID", "TransactionType", "Amount", "Branch",
+                                      "AgentName", "IdempotencyKey", "Hash"], transaction_rows)
+    sh.add_worksheet("user_balances", ["id", "balance"], [[k, v] for k, v in balances.items()])
+    sh.add_worksheet("users", ["username", "password", "negative_access", "edit_access"],
+                     [[f"agent{i}", AGENT_PASSWORD, "true", "false"] for i in range(1, agents + 1)])
+    return sh, ids
+
+def seed_shard(title, stats):
+    """
+    Builds an empty branch shard spreadsheet (see REEDY_BRANCH_SHARDS in test.py).
+    """
+    sh = FakeSpreadsheet(title, stats)
+    sh.add_worksheet("transactions", ["Timestamp", "ID", "TransactionType", "Amount", "Branch",
+                                      "AgentName", "IdempotencyKey", "Hash"])
+    sh.add_worksheet("user_balances", ["id", "balance"])
+    return sh
+
+def shard_titles(text):
+    """
+    Returns the shard spreadsheets named in a "Branch=spreadsheet,..." map.
+    """
+    titles = [part.partition("=")[2].strip() for part in text.split(",")]
+    return [title for title in dict.fromkeys(titles) if title and title != "database"]
+
+_FAKE_CLIENT = None
+_FAKE_LOCK = threading.Lock()
+
+def fake_client():
+    """
+    Returns the process-wide FakeClient, seeding it on first use from the
+    REEDY_FAKE_ACCOUNTS / REEDY_FAKE_TRANSACTIONS / REEDY_FAKE_LATENCY_MS
+    environment variables, plus an empty spreadsheet for every branch shard
+    in REEDY_BRANCH_SHARDS. With REEDY_FAKE_STATS set, the call counters are
+    written to that JSON file twice a second.
+    """
+    global _FAKE_CLIENT
+    with _FAKE_LOCK:
+        if _FAKE_CLIENT is None:
+            stats = BackendStats(float(os.environ.get("REEDY_FAKE_LATENCY_MS", "0")) / 1000)
+            sh, _ = seed_database(stats,
+                                  int(os.environ.get("REEDY_FAKE_ACCOUNTS", "2000")),
+                                  int(os.environ.get("REEDY_FAKE_TRANSACTIONS", "20000")))
+            shards = [seed_shard(title, stats) for title in shard_titles(os.environ.get("REEDY_BRANCH_SHARDS", ""))]
+            _FAKE_CLIENT = FakeClient([sh] + shards, stats)
+            if os.environ.get("REEDY_FAKE_STATS"):
+                stats.write_periodically(os.environ["REEDY_FAKE_STATS"])
+        return _FAKE_CLIENT
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Offline load test for the Streamlit app.
+#
+# Starts one "streamlit run test.py" server on the in-memory Sheets stand-in
+# (fakesheets.py, REEDY_BACKEND=fake) and connects N simulated agents to it
+# over Streamlit's websocket protocol, the way browsers do. Each level
+# reports throughput, latency percentiles and backend call counts:
+#
+#   python loadtest.py --levels 1,5,10,20 --duration 30
+#
+# All sessions share the one server process, so the numbers show how many
+# concurrent agents a single app instance serves before latency degrades.
+# Nothing here talks to Google.
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from fakesheets import AGENT_PASSWORD, fake_account_ids
+
+
+APP_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test.py")
+
+# ----------------------------------
+# 1) App server
+# ----------------------------------
+
+def start_app_server(port, accounts, transactions, latency_ms, stats_path, log_path):
+    """
+    Starts "streamlit run test.py" on the fake backend and waits until it
+    answers its health check. Returns the Popen.
+    """
+    env = dict(os.environ, REEDY_BACKEND="fake", REEDY_FAKE_ACCOUNTS=str(accounts),
+               REEDY_FAKE_TRANSACTIONS=str(transactions), REEDY_FAKE_LATENCY_MS=str(latency_ms),
+               REEDY_FAKE_STATS=stats_path)
+    log = open(log_path, "w", encoding="utf-8")
+    server = subprocess.Popen([sys.executable, "-m", "streamlit", "run", APP_SCRIPT,
+                               "--server.headless", "true", "--server.port", str(port),
+                               "--browser.gatherUsageStats", "false"],
+                              env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"streamlit exited with status {server.returncode}, see {log_path}")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/_stcore/health", timeout=1) as response:
+                if response.status == 200:
+                    return server
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError(f"streamlit did not start within 60s, see {log_path}")
+
+def read_backend_calls(stats_path):
+    """
+    Returns the server's cumulative backend call counters (see fakesheets.BackendStats).
+    """
+    time.sleep(0.6)  # the server rewrites the file every 0.5s
+    try:
+        with open(stats_path, encoding="utf-8") as f:
+            return Counter(json.load(f))
+    except (OSError, ValueError):
+        return Counter()
+
+# ----------------------------------
+# 2) Simulated agent sessions
+# ----------------------------------
+
+class OperationFailed(Exception):
+    """
+    The app answered, but not with the outcome the operation expects.
+    """
+
+class OperationRejected(Exception):
+    """
+    The app refused the operation with a business-rule message (e.g. a
+    DEDUCT below zero); counted apart from failures.
+    """
+
+class BrowserSession:
+    """
+    One browser tab: a websocket to the app that sends script reruns with
+    the current widget values and collects what each run rendered.
+    Widgets are looked up by label from the elements the server sent.
+    """
+
+    def __init__(self, port, timeout):
+        from websockets.sync.client import connect
+
+        self.timeout = timeout
+        self.connection = connect(f"ws://127.0.0.1:{port}/_stcore/stream", subprotocols=["streamlit"],
+                                  max_size=None, open_timeout=timeout)
+        self.widgets = {}  # label -> (widget id, fragment id)
+        self.values = {}   # widget id -> (WidgetState field, value)
+
+    def close(self):
+        self.connection.close()
+
+    def widget(self, label):
+        if label not in self.widgets:
+            raise OperationFailed(f"widget '{label}' not rendered")
+        return self.widgets[label]
+
+    def set(self, label, field, value):
+        self.values[self.widget(label)[0]] = (field, value)
+
+    def run(self, fragment_of=None, click=None):
+        """
+        Reruns the app (or, like the browser, only the fragment holding the
+        widget labelled 'fragment_of'), optionally clicking a button.
+        Returns [(element type, text)] of what the run rendered.
+        """
+        from streamlit.proto.BackMsg_pb2 import BackMsg
+        from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+        message = BackMsg()
+        state = message.rerun_script
+        state.query_string = ""
+        state.page_script_hash = ""
+        if fragment_of is not None:
+            state.fragment_id = self.widget(fragment_of)[1]
+        triggers = [(self.widget(click)[0], ("trigger_value", True))] if click else []
+        for widget_id, (field, value) in list(self.values.items()) + triggers:
+            widget_state = state.widget_states.widgets.add()
+            widget_state.id = widget_id
+            setattr(widget_state, field, value)
+        self.connection.send(message.SerializeToString())
+
+        rendered = []
+        done = (ForwardMsg.FINISHED_SUCCESSFULLY, ForwardMsg.FINISHED_FRAGMENT_RUN_SUCCESSFULLY)
+        while True:
+            forward = ForwardMsg()
+            forward.ParseFromString(self.connection.recv(timeout=self.timeout))
+            kind = forward.WhichOneof("type")
+            if kind == "script_finished" and forward.script_finished in done:
+                return rendered
+            if kind != "delta" or forward.delta.WhichOneof("type") != "new_element":
+                continue
+            element_type = forward.delta.new_element.WhichOneof("type")
+            element = getattr(forward.delta.new_element, element_type)
+            if element_type == "exception":
+                raise OperationFailed(f"{element.type}: {element.message}")
+            widget_id = getattr(element, "id", "")
+            if widget_id:
+                self.widgets[getattr(element, "label", "") or element_type] = (widget_id, forward.delta.fragment_id)
+                if getattr(element, "set_value", False):
+                    self.values.pop(widget_id, None)  # the app changed it; take its value
+            body = getattr(element, "body", None)
+            if isinstance(body, str):
+                rendered.append((element_type, body))
+
+def _expect(rendered, text, operation):
+    if any(text in body for _, body in rendered):
+        return
+    errors = [body for element_type, body in rendered if element_type == "alert"]
+    raise OperationFailed(f"{operation}: expected '{text}', got {errors or 'nothing'}")
+
+class AgentSession:
+    """
+    One simulated agent using the app through a BrowserSession. Every
+    operation checks that the page shows its success message.
+    """
+
+    def __init__(self, agent, ids, rng, port, timeout):
+        self.agent = agent
+        self.ids = ids
+        self.rng = rng
+        self.port = port
+        self.timeout = timeout
+        self.browser = None
+
+    def close(self):
+        if self.browser is not None:
+            self.browser.close()
+            self.browser = None
+
+    def login(self):
+        self.close()
+        self.browser = BrowserSession(self.port, self.timeout)
+        self.browser.run()
+        self.browser.set("Username", "string_value", self.agent)
+        self.browser.set("Password", "string_value", AGENT_PASSWORD)
+        _expect(self.browser.run(click="Login"), f"Welcome, **{self.agent}**", "login")
+
+    def _open_page(self, page):
+        # The sidebar option_menu is a custom component; its value is the page name
+        self.browser.set("component_instance", "json_value", json.dumps(page))
+        self.browser.run()
+
+    def transaction(self):
+        self._open_page("Transaction Recorder")
+        self.browser.set("ID Number", "string_value", self.rng.choice(self.ids))
+        _expect(self.browser.run(fragment_of="ID Number"), "Current Balance", "balance lookup")
+        self.browser.set("Transaction Type", "string_value", self.rng.choice(["ADD", "ADD", "DEDUCT"]))
+        self.browser.set("Amount", "double_value", float(self.rng.randint(1, 200)))
+        self.browser.set("Agent Name", "string_value", self.agent)
+        rendered = self.browser.run(fragment_of="Record Transaction", click="Record Transaction")
+        if any("does not allow a negative balance" in body for _, body in rendered):
+            raise OperationRejected("negative balance not allowed")
+        _expect(rendered, "Transaction recorded", "transaction")
+
+    def search(self):
+        self._open_page("Search Account")
+        self.browser.set("Enter ID Number to Search", "string_value", self.rng.choice(self.ids))
+        _expect(self.browser.run(fragment_of="Search", click="Search"), "Current Balance", "search")
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+def run_level(concurrency, duration, mix, ids, port, timeout, seed):
+    """
+    Runs 'concurrency' sessions for 'duration' seconds. Each iteration picks
+    an operation by weight; 'login' opens a fresh browser session.
+    Returns (latencies by operation, rejections, failures, elapsed seconds).
+    Only operations whose success message was shown count as latencies.
+    """
+    latencies = defaultdict(list)
+    rejections = Counter()
+    failures = Counter()
+    lock = threading.Lock()
+    operations, weights = zip(*mix.items())
+    deadline = time.perf_counter() + duration
+
+    def worker(index):
+        rng = random.Random(seed * 1000 + index)
+        session = AgentSession(f"agent{index % 50 + 1}", ids, rng, port, timeout)
+        operation = "login"
+        try:
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    if operation == "login" or session.browser is None:
+                        operation = "login"
+                        session.login()
+                    else:
+                        getattr(session, operation)()
+                    with lock:
+                        latencies[operation].append(time.perf_counter() - started)
+                except OperationRejected as e:
+                    with lock:
+                        rejections[f"{operation}: {e}"] += 1
+                except Exception as e:
+                    with lock:
+                        failures[f"{operation}: {type(e).__name__}: {e}"[:160]] += 1
+                    session.close()
+                operation = rng.choices(operations, weights)[0]
+        finally:
+            session.close()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    return latencies, rejections, failures, time.perf_counter() - started
+
+def print_report(concurrency, latencies, rejections, failures, elapsed, calls):
+    total = sum(len(values) for values in latencies.values())
+    print(f"\n=== {concurrency} concurrent session(s): {total} successful operations in {elapsed:.1f}s "
+          f"({total / elapsed:.2f} ops/s), {sum(failures.values())} failed ===")
+    print(f"{'operation':<12} {'count':>6} {'ops/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for operation, values in sorted(latencies.items()):
+        print(f"{operation:<12} {len(values):>6} {len(values) / elapsed:>7.2f} "
+              f"{percentile(values, 50) * 1000:>8.0f} {percentile(values, 95) * 1000:>8.0f} "
+              f"{percentile(values, 99) * 1000:>8.0f} {max(values) * 1000:>8.0f}")
+    print(f"backend calls: {sum(calls.values())} total, {sum(calls.values()) / max(total, 1):.1f} per operation")
+    for name, count in calls.most_common():
+        print(f"  {name:<40} {count:>8}")
+    for message, count in rejections.most_common(10):
+        print(f"  REJECTED x{count}: {message}")
+    for message, count in failures.most_common(10):
+        print(f"  FAILED x{count}: {message}")
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in ("login", "transaction", "search"):
+            raise argparse.ArgumentTypeError(f"unknown operation '{name}'")
+        mix[name] = float(weight or 1)
+    return mix
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline concurrent load test of the Streamlit app.")
+    parser.add_argument("--levels", default="1,5,10,20", help="Comma separated concurrency levels")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds per level")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("login=1,transaction=6,search=3"),
+                        help="Operation weights (default: login=1,transaction=6,search=3)")
+    parser.add_argument("--accounts", type=int, default=2000)
+    parser.add_argument("--transactions", type=int, default=20000)
+    parser.add_argument("--latency-ms", type=float, default=0, help="Simulated latency per backend call")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for one script run")
+    parser.add_argument("--port", type=int, default=8599, help="Port of the app server under test")
+    parser.add_argument("--server-log", default=os.path.join(tempfile.gettempdir(), "reedy_loadtest_server.log"))
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    stats_path = os.path.join(tempfile.mkdtemp(prefix="reedy_loadtest_"), "backend_calls.json")
+    server = start_app_server(args.port, args.accounts, args.transactions, args.latency_ms,
+                              stats_path, args.server_log)
+    print(f"App server on port {args.port} (log: {args.server_log}); fake backend: {args.accounts} accounts, "
+          f"{args.transactions} transactions, {args.latency_ms:g} ms per call")
+    ids = fake_account_ids(args.accounts)
+    failed = False
+    try:
+        for concurrency in [int(level) for level in args.levels.split(",")]:
+            calls_before = read_backend_calls(stats_path)
+            latencies, rejections, failures, elapsed = run_level(concurrency, args.duration, args.mix, ids,
+                                                                 args.port, args.timeout, args.seed)
+            calls = read_backend_calls(stats_path)
+            calls.subtract(calls_before)
+            print_report(concurrency, latencies, rejections, failures, elapsed, +calls)
+            failed = failed or bool(failures)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
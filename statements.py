@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Statement rendering for batch statement generation (see
+# build_company_statements / write_statements_zip in test.py).
+# These functions live in their own module so a process pool can import
+# them; they only take and return plain Python data.
+
+import csv
+import io
+import os
+import re
+from functools import lru_cache
+
+
+STATEMENT_COLUMNS = ["Date & Time", "Type", "Amount", "Branch", "Agent Name", "Balance"]
+
+def statement_rows(statement):
+    """
+    Yields one display row per transaction with the running balance.
+    """
+    balance = statement["opening_balance"]
+    for timestamp, transaction_type, amount, branch, agent_name in statement["transactions"]:
+        if transaction_type == "ADD":
+            balance += amount
+        elif transaction_type == "DEDUCT":
+            balance -= amount
+        yield [timestamp, transaction_type, f"{amount:.2f}", branch, agent_name, f"{balance:.2f}"]
+
+def render_statement_csv(statement):
+    """
+    Renders one account statement as UTF-8 CSV (with BOM, so Excel shows Arabic names).
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["Account ID", statement["id"]])
+    writer.writerow(["Name", statement["name"]])
+    writer.writerow(["Company", statement["company"]])
+    writer.writerow(["Branch", statement["branch"]])
+    writer.writerow(["Period", f"{statement['period_start']} to {statement['period_end']}"])
+    writer.writerow(["Opening Balance", f"{statement['opening_balance']:.2f}"])
+    writer.writerow([])
+    writer.writerow(STATEMENT_COLUMNS)
+    writer.writerows(statement_rows(statement))
+    writer.writerow([])
+    writer.writerow(["Closing Balance", f"{statement['closing_balance']:.2f}"])
+    return buffer.getvalue().encode("utf-8-sig")
+
+# reportlab's built-in fonts have no Arabic glyphs, so PDFs use a TrueType
+# font that does: REEDY_PDF_FONT if set, else the first of these that exists.
+PDF_FONT_NAME = "StatementFont"
+PDF_FONT_CANDIDATES = [
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts", "NotoNaskhArabic-Regular.ttf"),
+    "/usr/share/fonts/truetype/noto/NotoNaskhArabic-Regular.ttf",
+    "/usr/share/fonts/truetype/noto/NotoSansArabic-Regular.ttf",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/truetype/freefont/FreeSerif.ttf",
+    "C:\\Windows\\Fonts\\arial.ttf",
+    "/Library/Fonts/Arial Unicode.ttf",
+]
+
+# Optional packages the PDF format needs (pip install reportlab arabic-reshaper python-bidi)
+PDF_PACKAGES = ("reportlab", "arabic_reshaper", "bidi")
+
+def pdf_available():
+    """
+    True if the packages PDF statements need are installed. A font with
+    Arabic glyphs is still needed (see pdf_font).
+    """
+    from importlib.util import find_spec
+
+    return all(find_spec(name) is not None for name in PDF_PACKAGES)
+
+ARABIC_CHARS = re.compile("[\u0600-\u06FF\u0750-\u077F\uFB50-\uFDFF\uFE70-\uFEFF]")
+
+@lru_cache(maxsize=None)
+def pdf_font():
+    """
+    Registers the statement font with reportlab (once per process) and
+    returns its name.
+    """
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+
+    configured = os.environ.get("REEDY_PDF_FONT")
+    for path in [configured] if configured else PDF_FONT_CANDIDATES:
+        if os.path.isfile(path):
+            pdfmetrics.registerFont(TTFont(PDF_FONT_NAME, path))
+            return PDF_FONT_NAME
+    raise RuntimeError("PDF statements need a TrueType font with Arabic glyphs "
+                       "(e.g. NotoNaskhArabic-Regular.ttf); set REEDY_PDF_FONT to its path.")
+
+def pdf_text(value):
+    """
+    Prepares text for reportlab, which draws characters left to right as
+    given: Arabic is reshaped into joined letter forms and put in visual
+    (right-to-left) order.
+    """
+    import arabic_reshaper
+    from bidi.algorithm import get_display
+
+    text = str(value)
+    return get_display(arabic_reshaper.reshape(text)) if ARABIC_CHARS.search(text) else text
+
+def render_statement_pdf(statement):
+    """
+    Renders one account statement as a PDF. Needs the optional 'reportlab',
+    'arabic-reshaper' and 'python-bidi' packages and an Arabic font (see pdf_font).
+    """
+    try:
+        import arabic_reshaper  # noqa: F401 (used by pdf_text)
+        import bidi.algorithm  # noqa: F401 (used by pdf_text)
+        from reportlab.lib import colors
+        from reportlab.lib.pagesizes import A4
+        from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+        from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+    except ImportError:
+        raise RuntimeError("PDF statements need the 'reportlab', 'arabic-reshaper' and 'python-bidi' packages "
+                           "(pip install reportlab arabic-reshaper python-bidi).")
+
+    font = pdf_font()
+    title_style = ParagraphStyle("StatementTitle", parent=getSampleStyleSheet()["Title"], fontName=font)
+    buffer = io.BytesIO()
+    document = SimpleDocTemplate(buffer, pagesize=A4, title=f"Statement {statement['id']}")
+
+    header = [
+        ["Account ID", statement["id"]],
+        ["Name", pdf_text(statement["name"])],
+        ["Company", pdf_text(statement["company"])],
+        ["Branch", pdf_text(statement["branch"])],
+        ["Period", f"{statement['period_start']} to {statement['period_end']}"],
+        ["Opening Balance", f"{statement['opening_balance']:.2f} EGP"],
+        ["Closing Balance", f"{statement['closing_balance']:.2f} EGP"],
+    ]
+    rows = [[pdf_text(value) for value in row] for row in statement_rows(statement)]
+    table = Table([STATEMENT_COLUMNS] + rows, repeatRows=1)
+    table.setStyle(TableStyle([
+        ("FONTNAME", (0, 0), (-1, -1), font),
+        ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
+        ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
+        ("FONTSIZE", (0, 0), (-1, -1), 8),
+    ]))
+    header_table = Table(header)
+    header_table.setStyle(TableStyle([("FONTNAME", (0, 0), (-1, -1), font)]))
+    document.build([
+        Paragraph("Elreedy Pharmacies - Account Statement", title_style),
+        header_table,
+        Spacer(1, 12),
+        table,
+    ])
+    return buffer.getvalue()
+
+RENDERERS = {
+    "csv": render_statement_csv,
+    "pdf": render_statement_pdf,
+}
+
+def render_statement_chunk(statements, fmt):
+    """
+    Renders a chunk of statements. Returns a list of (filename, bytes).
+    Runs inside the process pool, one call per chunk.
+    """
+    render = RENDERERS[fmt]
+    return [(f"{statement['id']}.{fmt}", render(statement)) for statement in statements]
@@ -0,0 +1,44 @@
+# coding: utf-8
+
+# The app lives in test.py, which would clash with the standard library's
+# "test" package, so it is loaded from its path as the module "reedy_app".
+
+import importlib.util
+import os
+import sys
+
+import pytest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+@pytest.fixture(scope="session")
+def app():
+    spec = importlib.util.spec_from_file_location("reedy_app", os.path.join(ROOT, "test.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.fixture
+def sheets():
+    """
+    A small seeded fake 'database' spreadsheet: (client, spreadsheet, account IDs).
+    """
+    from fakesheets import BackendStats, FakeClient, seed_database
+
+    stats = BackendStats()
+    spreadsheet, ids = seed_database(stats, accounts=50, transactions=200)
+    return FakeClient([spreadsheet], stats), spreadsheet, ids
+
+@pytest.fixture
+def service(app, sheets):
+    """
+    An AccountService on the fake spreadsheet, without branch shards.
+    """
+    client, _, _ = sheets
+    shard_map = app.load_shard_map("")
+    read_model = app.SharedReadModel(app.ConditionalTableLoader(
+        client_factory=lambda: client, fetch_revision=lambda *args: None, shard_map=shard_map))
+    return app.AccountService(app.open_backend(client, shard_map=shard_map), read_model,
+                              alert_engine=app.AlertEngine(log_path=""))
@@ -0,0 +1,23 @@
+# coding: utf-8
+
+# Account writes through AccountService and the acting agent's access.
+
+import pytest
+
+
+def test_update_needs_edit_access_and_negative_access_for_the_flag(app, service, sheets):
+    _, _, ids = sheets
+    row_num, account = service.get_account(ids[0])
+    flag = account["CanHaveNegativeBalance"].strip().lower() == "true"
+
+    def update(agent, can_negative):
+        service.update_account(row_num, account, "Renamed", account["Company"], can_negative,
+                               account["PhoneNumber"], account["Branch"], agent)
+
+    with pytest.raises(app.PermissionDeniedError):
+        update(app.Agent("agent1", True, False), flag)
+    with pytest.raises(app.PermissionDeniedError):
+        update(app.Agent("agent1", False, True), not flag)
+    update(app.Agent("agent1", False, True), flag)
+    update(app.Agent("agent1", True, True), not flag)
+    assert service.get_account(ids[0])[1]["CanHaveNegativeBalance"] == str(not flag)
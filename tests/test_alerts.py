@@ -0,0 +1,30 @@
+# coding: utf-8
+
+# Balance alert rules (AlertEngine), fed by AccountService.record_transaction.
+
+
+def set_balance(spreadsheet, user_id, balance):
+    ws = spreadsheet.worksheet("user_balances")
+    rows = ws.get_all_values()
+    row = next((i for i, values in enumerate(rows, start=1) if values[0] == str(user_id)), None)
+    if row is None:
+        ws.append_row([user_id, balance])
+    else:
+        ws.update_cell(row, 2, balance)
+
+def test_negative_balance_fires_once_until_the_account_recovers(service, sheets):
+    _, spreadsheet, _ = sheets
+    accounts = spreadsheet.worksheet("accounts").get_all_values()[1:]
+    user_id = next(int(values[0]) for values in accounts if values[5] == "False")
+
+    def rules(amount):
+        before = service.alert_engine.total
+        service.record_transaction(user_id, "ADD", amount, "Nasser", "agent1")
+        return [alert.rule for alert in service.alert_engine.recent(service.alert_engine.total - before)]
+
+    set_balance(spreadsheet, user_id, -100)  # e.g. a manual sheet edit
+    assert rules(10) == ["negative_balance"]
+    assert rules(10) == []                   # still negative: already reported
+    assert rules(200) == []                  # recovered
+    set_balance(spreadsheet, user_id, -5)
+    assert rules(1) == ["negative_balance"]
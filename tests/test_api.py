@@ -0,0 +1,96 @@
+# coding: utf-8
+
+# HTTP API (test.py serve) on the in-memory Sheets stand-in.
+
+import base64
+import json
+import socket
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from fakesheets import AGENT_PASSWORD
+
+
+@pytest.fixture
+def api(app, sheets, service, monkeypatch):
+    monkeypatch.setattr(app.ApiRequestHandler, "timeout", 0.5)
+    server = app.make_api_server(service, port=0, workers=1, quiet=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", sheets[2]
+    server.shutdown()
+    server.server_close()
+
+def request(url, payload=None, user="agent1", password=AGENT_PASSWORD):
+    data = None if payload is None else json.dumps(payload).encode("utf-8")
+    headers = {}
+    if user is not None:
+        headers["Authorization"] = "Basic " + base64.b64encode(f"{user}:{password}".encode("utf-8")).decode("ascii")
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=data, headers=headers), timeout=5) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+def test_idle_keep_alive_connection_releases_its_worker(api):
+    base, _ = api
+    host, port = base.rsplit("/", 1)[-1].split(":")
+    idle = socket.create_connection((host, int(port)))  # holds the only worker until it times out
+    try:
+        assert request(f"{base}/health")[0] == 200
+    finally:
+        idle.close()
+
+def test_unknown_branch_and_company_are_rejected(api):
+    base, ids = api
+    status, body = request(f"{base}/transactions", {"id": ids[0], "transaction_type": "ADD", "amount": 5,
+                                                     "branch": "Atlantis", "agent_name": "agent1"})
+    assert status == 400 and "Branch" in body["error"]
+
+    status, body = request(f"{base}/accounts", {"id": "29999999999999", "name": "New", "company": "Nowhere",
+                                                 "creator_agent": "agent1", "branch": "Nasser",
+                                                 "phone_number": "01012345678", "registered_by": "agent1"})
+    assert status == 400 and "Company" in body["error"]
+
+def test_search_limit_must_be_a_number(api):
+    base, _ = api
+    assert request(f"{base}/search/accounts?name=x&limit=ten")[0] == 400
+    assert request(f"{base}/search/accounts?name=x&limit=0")[0] == 400
+
+def new_account(**fields):
+    return dict({"id": "29999999999999", "name": "New", "company": "AXA", "creator_agent": "agent1",
+                 "branch": "Nasser", "phone_number": "01012345678"}, **fields)
+
+def test_requests_act_for_an_authenticated_agent(api):
+    base, ids = api
+    assert request(f"{base}/health", user=None)[0] == 200
+    assert request(f"{base}/accounts/{ids[0]}/balance", user=None)[0] == 401
+    assert request(f"{base}/accounts/{ids[0]}/balance", password="wrong")[0] == 401
+    assert request(f"{base}/accounts/{ids[0]}/balance")[0] == 200
+
+def test_negative_balance_flag_needs_negative_access(api, sheets):
+    base, _ = api
+    _, spreadsheet, _ = sheets
+    spreadsheet.worksheet("users").update_cell(3, 3, "false")  # agent2
+
+    status, _ = request(f"{base}/accounts", new_account(can_negative_balance=True), user="agent2")
+    assert status == 403
+    assert request(f"{base}/accounts/29999999999999")[0] == 404
+
+    status, _ = request(f"{base}/accounts", new_account(can_negative_balance=True, registered_by="nobody"))
+    assert status == 201
+    status, account = request(f"{base}/accounts/29999999999999")
+    assert (account["CanHaveNegativeBalance"], account["RegisteredBy"]) == ("True", "agent1")
+
+def test_malformed_audit_dates_are_rejected(api):
+    base, _ = api
+    status, body = request(f"{base}/audit/transactions?start=garbage")
+    assert status == 400 and "start" in body["error"]
+    assert request(f"{base}/audit/transactions?start=2024-01-01&end=2024-12-31")[0] == 200
+
+def test_history_of_an_unknown_account_is_not_found(api):
+    base, ids = api
+    assert request(f"{base}/accounts/29999999999999/history")[0] == 404
+    assert request(f"{base}/accounts/{ids[0]}/history")[0] == 200
@@ -0,0 +1,74 @@
+# coding: utf-8
+
+# Hash-chained transaction appends (ChainTails, record_transaction, verify_chain).
+
+
+def transactions_calls(spreadsheet):
+    calls = spreadsheet.stats.reset()
+    return {name.split(".", 1)[1]: count for name, count in calls.items() if name.startswith("transactions.")}
+
+def test_appends_after_the_first_read_nothing(app, sheets):
+    _, spreadsheet, ids = sheets
+    ws = spreadsheet.worksheet("transactions")
+    app.get_chain_tails.clear()
+    spreadsheet.stats.reset()
+
+    app.record_transaction(ws, ids[0], "ADD", 10, "Nasser", "agent1")
+    first = transactions_calls(spreadsheet)
+    app.record_transaction(ws, ids[1], "ADD", 20, "Nasser", "agent1")
+    second = transactions_calls(spreadsheet)
+
+    assert "col_values" not in first and first.get("cell") == 1
+    assert second == {"append_row": 1}
+
+def test_rows_from_another_process_are_chained_around(app, sheets, tmp_path, monkeypatch):
+    _, spreadsheet, ids = sheets
+    ws = spreadsheet.worksheet("transactions")
+    ours, theirs = app.ChainTails(), app.ChainTails()
+
+    for tails, user_id in [(ours, ids[0]), (theirs, ids[1]), (ours, ids[2]), (ours, ids[3]), (theirs, ids[4])]:
+        monkeypatch.setattr(app, "get_chain_tails", lambda tails=tails: tails)
+        app.record_transaction(ws, user_id, "ADD", 10, "Suez", "agent2")
+
+    report = app.verify_chain(ws, full=True, checkpoint_path=str(tmp_path / "checkpoints.json"))
+    assert report.broken == 0 and report.checked == 205
+
+def test_a_crash_before_the_fix_up_breaks_only_that_row(app, sheets, tmp_path, monkeypatch):
+    _, spreadsheet, ids = sheets
+    ws = spreadsheet.worksheet("transactions")
+    checkpoints = str(tmp_path / "checkpoints.json")
+
+    def crash(*args, **kwargs):
+        raise RuntimeError("process stopped")
+
+    app.record_transaction(ws, ids[0], "ADD", 5, "Nasser", "agent1")  # row 202 starts the chain
+
+    # A fresh process does not know the tail, so its first row (203) needs the fix-up
+    monkeypatch.setattr(app, "get_chain_tails", app.ChainTails)
+    monkeypatch.setattr(ws, "update_cell", crash)
+    try:
+        app.record_transaction(ws, ids[1], "ADD", 10, "Nasser", "agent1")
+    except RuntimeError:
+        pass
+    monkeypatch.undo()
+    app.record_transaction(ws, ids[2], "ADD", 20, "Nasser", "agent1")
+
+    report = app.verify_chain(ws, full=True, checkpoint_path=checkpoints)
+    assert report.broken_rows == [203]
+
+    # The repair described in section 1.j: re-chain row 203 and every row after it
+    values = ws.get_all_values()
+    previous = values[201][app.HASH_COLUMN - 1]
+    for row in range(203, len(values) + 1):
+        previous = app.chain_hash(previous, app.canonical_transaction(values[row - 1][:app.HASH_COLUMN - 1]))
+        ws.update_cell(row, app.HASH_COLUMN, previous)
+    assert app.verify_chain(ws, full=True, checkpoint_path=checkpoints).broken == 0
+
+def test_misplaced_headers_are_reported(app, sheets):
+    client, spreadsheet, _ = sheets
+    backend = app.open_backend(client, shard_map=app.load_shard_map(""))
+    assert app.transaction_header_problems(backend.router.shards) == []
+
+    spreadsheet.worksheet("transactions").update_cell(1, app.HASH_COLUMN, "Checksum")
+    assert app.transaction_header_problems(backend.router.shards) == [
+        "Cell H1 of 'transactions' in 'database' must read 'Hash'."]
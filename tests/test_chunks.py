@@ -0,0 +1,34 @@
+# coding: utf-8
+
+# Streaming worksheets in chunked range reads (iter_typed_chunks).
+
+from datetime import date, timedelta
+
+from fakesheets import BackendStats, FakeSpreadsheet
+
+
+def balances_sheet(rows):
+    spreadsheet = FakeSpreadsheet("chunks", BackendStats())
+    return spreadsheet.add_worksheet("user_balances", ["id", "balance"], rows)
+
+def streamed_ids(app, ws, chunk_rows, **kwargs):
+    df = app.concat_typed_frames(app.iter_typed_chunks(ws, "user_balances", chunk_rows, **kwargs), "user_balances")
+    return df["id"].tolist()
+
+def test_blank_rows_at_a_chunk_boundary_do_not_end_the_stream(app):
+    # Rows 2-4 hold data, rows 5-6 end the first 5-row range blank, row 7 follows
+    ws = balances_sheet([[1, 10], [2, 20], [3, 30], [], [], [4, 40]])
+    ids = streamed_ids(app, ws, chunk_rows=5)
+    assert [i for i in ids if i >= 0] == [1, 2, 3, 4]
+    assert len(ids) == 6  # blanks kept, so rows keep their sheet positions
+
+def test_a_blank_chunk_mid_sheet_does_not_end_the_stream(app):
+    ws = balances_sheet([[1, 10]] + [[]] * 8 + [[2, 20]])
+    ids = streamed_ids(app, ws, chunk_rows=3)
+    assert ids[0] == 1 and ids[-1] == 2 and len(ids) == 10
+
+def test_streamed_audit_matches_the_read_model(service):
+    start, end = date.today() - timedelta(days=365), date.today()
+    streamed = list(service.stream_audit_transactions(start, end, branch="Suez"))
+    expected = service.audit_transactions(start, end, branch="Suez")
+    assert sum(len(chunk) for chunk in streamed) == len(expected) > 0
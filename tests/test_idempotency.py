@@ -0,0 +1,39 @@
+# coding: utf-8
+
+# Idempotent transaction submission (AccountService.record_transaction).
+
+import pytest
+
+
+def test_repeated_key_returns_original_result(service, sheets):
+    _, _, ids = sheets
+    first = service.record_transaction(ids[0], "ADD", 25, "Nasser", "agent1", "key-1")
+    again = service.record_transaction(ids[0], "ADD", 25, "Nasser", "agent1", "key-1")
+
+    assert again["replayed"] and not first["replayed"]
+    assert again["new_balance"] == first["new_balance"]
+    assert service.get_balance(ids[0]) == first["new_balance"]
+
+def test_replay_after_restart_reads_the_stored_row(app, service, sheets):
+    _, _, ids = sheets
+    committed = service.record_transaction(ids[1], "ADD", 40, "Suez", "agent7", "key-2")
+
+    # A restarted process: empty key index, read model loaded from the sheet
+    service.idempotency_index = app.IdempotencyIndex()
+    service.read_model.refresh()
+    replayed = service.record_transaction(ids[1], "ADD", 40, "Suez", "agent7", "key-2")
+
+    assert replayed["replayed"]
+    assert (replayed["transaction_type"], replayed["amount"], replayed["branch"], replayed["agent_name"]) == \
+        ("ADD", 40.0, "Suez", "agent7")
+    assert replayed["new_balance"] == committed["new_balance"]
+
+def test_reused_key_with_a_different_payload_is_a_conflict(app, service, sheets):
+    _, spreadsheet, ids = sheets
+    service.record_transaction(ids[2], "ADD", 30, "Farz", "agent3", "key-3")
+    appended = spreadsheet.stats.snapshot()["transactions.append_row"]
+
+    for transaction_type, amount, branch in [("DEDUCT", 30, "Farz"), ("ADD", 31, "Farz"), ("ADD", 30, "Suez")]:
+        with pytest.raises(app.ConflictError):
+            service.record_transaction(ids[2], transaction_type, amount, branch, "agent3", "key-3")
+    assert spreadsheet.stats.snapshot()["transactions.append_row"] == appended
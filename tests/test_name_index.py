@@ -0,0 +1,31 @@
+# coding: utf-8
+
+# Name search index kept in step with read model snapshots (NameSearchIndex).
+
+import pandas as pd
+
+
+def test_stale_snapshot_keeps_a_freshly_added_name(app):
+    index = app.NameSearchIndex()
+    index.sync({"1": "محمد عيسى"}, version=3)
+    index.add("2", "احمد سالم", version=3)
+    index.add("1", "محمد عصام", version=3)
+
+    # Version 4 may come from a reload that started before the writes
+    index.sync({"1": "محمد عيسى"}, version=4)
+    assert [key for key, _, _ in index.search("احمد سالم")] == ["2"]
+    assert index.search("محمد عصام")[0][1] == "محمد عصام"
+
+    # Version 5 started after them, so it is authoritative
+    index.sync({"1": "محمد عصام"}, version=5)
+    assert index.search("احمد سالم") == []
+
+def test_older_snapshot_is_ignored(app):
+    index = app.NameSearchIndex()
+    newer = app.ReadSnapshot(2, None, {"accounts": pd.DataFrame({"ID": [1, 2], "Name": ["سارة", "ليلى"]})})
+    older = app.ReadSnapshot(1, None, {"accounts": pd.DataFrame({"ID": [1], "Name": ["سارة"]})})
+
+    app.sync_name_index(index, newer)
+    app.sync_name_index(index, older)
+    assert index.synced_version == 2
+    assert [key for key, _, _ in index.search("ليلى")] == ["2"]
@@ -0,0 +1,86 @@
+# coding: utf-8
+
+# Finding a period in the time-ordered 'transactions' sheet
+# (find_timestamp_rows, iter_transaction_period).
+
+from datetime import date, datetime, timedelta
+
+from fakesheets import BackendStats, FakeSpreadsheet
+
+
+START = datetime(2026, 1, 1)
+STEP = timedelta(hours=6)  # four rows a day
+
+def stamp(i):
+    return START + i * STEP
+
+def transactions_sheet(app, stamps, blank_tail=0, stats=None):
+    """
+    A 'transactions' sheet with one row per timestamp (ID = its index),
+    followed by blank_tail empty rows.
+    """
+    spreadsheet = FakeSpreadsheet("period", stats or BackendStats())
+    rows = [[ts.strftime(app.TIMESTAMP_FORMAT), i, "Deposit", "1", "Cairo", "agent1", "", ""]
+            for i, ts in enumerate(stamps)]
+    return spreadsheet.add_worksheet("transactions", list(app.TABLE_SCHEMAS["transactions"]),
+                                     rows + [[]] * blank_tail)
+
+def period_ids(app, ws, start_date, end_date, chunk_rows=10):
+    df = app.concat_typed_frames(app.iter_transaction_period(ws, start_date, end_date, chunk_rows), "transactions")
+    return [i for i in df["ID"].tolist() if i >= 0]
+
+def test_bounds_are_inclusive(app):
+    ws = transactions_sheet(app, [stamp(i) for i in range(100)])
+    # Row i + 2 holds stamp(i)
+    assert app.find_timestamp_rows(ws, stamp(10), stamp(20)) == (12, 22)
+    assert app.find_timestamp_rows(ws, stamp(10) + timedelta(seconds=1), stamp(20) - timedelta(seconds=1)) == (13, 21)
+
+def test_bounds_at_the_ends_of_the_sheet(app):
+    ws = transactions_sheet(app, [stamp(i) for i in range(100)])
+    assert app.find_timestamp_rows(ws, stamp(-5), stamp(0)) == (2, 2)
+    assert app.find_timestamp_rows(ws, stamp(99), stamp(200)) == (101, None)
+
+def test_blank_tail_rows_end_the_period(app):
+    ws = transactions_sheet(app, [stamp(i) for i in range(100)], blank_tail=30)
+    assert app.find_timestamp_rows(ws, stamp(90), stamp(200)) == (92, None)
+    assert app.find_timestamp_rows(ws, stamp(10), stamp(20)) == (12, 22)
+    assert app.find_timestamp_rows(ws, stamp(200), stamp(300))[0] > 101
+
+def test_an_empty_period_reads_no_rows(app):
+    stats = BackendStats()
+    ws = transactions_sheet(app, [stamp(i) for i in range(100)], stats=stats)
+    first_row, last_row = app.find_timestamp_rows(ws, stamp(10) + timedelta(hours=1), stamp(10) + timedelta(hours=2))
+    assert last_row < first_row
+    stats.reset()
+    assert period_ids(app, ws, date(2025, 6, 1), date(2025, 6, 30)) == []
+    assert "transactions.get_values" not in stats.snapshot()
+
+def test_only_the_period_is_streamed(app):
+    ws = transactions_sheet(app, [stamp(i) for i in range(400)])
+    ids = period_ids(app, ws, date(2026, 1, 11), date(2026, 1, 11))
+    assert set(range(40, 44)) <= set(ids) and len(ids) < 20
+
+def test_probed_rows_out_of_order_stream_the_whole_sheet(app):
+    stamps = [stamp(i) for i in range(10)]
+    stamps[5] = stamp(-100)
+    ws = transactions_sheet(app, stamps)
+    assert app.find_timestamp_rows(ws, stamp(2), stamp(3)) is None
+    assert sorted(period_ids(app, ws, date(2026, 1, 1), date(2026, 1, 1))) == list(range(10))
+
+def test_an_out_of_order_slice_falls_back_to_the_whole_sheet(app, monkeypatch):
+    # Row 42 is stamped on the 1st and row 5 on the 11th; a search whose
+    # probes missed both returns the slice of the 11th, which holds row 42
+    stamps = [stamp(i) for i in range(100)]
+    stamps[3], stamps[40] = stamps[40], stamps[3]
+    ws = transactions_sheet(app, stamps)
+    monkeypatch.setattr(app, "find_timestamp_rows", lambda *args, **kwargs: (40, 48))
+    ids = period_ids(app, ws, date(2026, 1, 11), date(2026, 1, 11))
+    assert sorted(ids) == list(range(100))  # every row, once
+
+def test_small_skew_within_the_slice_is_tolerated(app, monkeypatch):
+    # Concurrent writers can append rows a few seconds out of order
+    stamps = [stamp(i) for i in range(100)]
+    stamps[42] = stamps[41] - timedelta(seconds=5)
+    ws = transactions_sheet(app, stamps)
+    monkeypatch.setattr(app, "find_timestamp_rows", lambda *args, **kwargs: (40, 48))
+    assert sorted(period_ids(app, ws, date(2026, 1, 11), date(2026, 1, 11))) == list(range(38, 47))
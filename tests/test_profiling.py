@@ -0,0 +1,38 @@
+# coding: utf-8
+
+# Admin page profiling (page_fragment, run_profiled).
+
+import os
+import sys
+
+from streamlit.testing.v1 import AppTest
+
+
+def profiled_page_script(app_path, profile_dir):
+    import importlib.util
+
+    import streamlit as st
+
+    spec = importlib.util.spec_from_file_location("reedy_app", app_path)
+    app = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(app)
+    app.PROFILE_DIR = profile_dir
+    st.session_state.profile_pages = True
+
+    @app.page_fragment
+    def page_demo(service):
+        st.button("Go")
+
+    app.PAGES.append(app.Page("Demo", "app", page_demo))
+    page_demo(None)
+
+def test_widget_reruns_inside_a_page_are_profiled(app, tmp_path, monkeypatch):
+    # AppTest runs its script as __main__; later spawn pools must not see it
+    monkeypatch.setitem(sys.modules, "__main__", sys.modules["__main__"])
+    at = AppTest.from_function(profiled_page_script, args=(app.__file__, str(tmp_path)), default_timeout=60)
+    at.run()
+    at.button[0].click().run()
+
+    assert not at.exception
+    assert [expander.label for expander in at.expander] == ["Profile: Demo"]
+    assert len([name for name in os.listdir(tmp_path) if name.endswith("_demo.prof")]) == 2
@@ -0,0 +1,51 @@
+# coding: utf-8
+
+# The per-run read cache (rerun_scope, cached_read, invalidate_reads).
+
+
+def test_the_same_read_is_made_once_per_run(app, sheets):
+    _, spreadsheet, ids = sheets
+    accounts_ws = spreadsheet.worksheet("accounts")
+    stats = spreadsheet.stats
+    stats.reset()
+    with app.rerun_scope():
+        rows = {app.find_account_by_id(accounts_ws, ids[0]) for _ in range(3)}
+        app.cached_records(accounts_ws)
+        app.cached_records(accounts_ws)
+    assert len(rows) == 1 and None not in rows
+    assert stats.reset() == {"accounts.find": 1, "accounts.get_all_records": 1}
+
+    # The next run reads again
+    with app.rerun_scope():
+        app.find_account_by_id(accounts_ws, ids[0])
+    assert stats.snapshot() == {"accounts.find": 1}
+
+def test_reads_outside_a_run_are_not_cached(app, sheets):
+    _, spreadsheet, ids = sheets
+    accounts_ws = spreadsheet.worksheet("accounts")
+    spreadsheet.stats.reset()
+    app.find_account_by_id(accounts_ws, ids[0])
+    app.find_account_by_id(accounts_ws, ids[0])
+    assert spreadsheet.stats.snapshot() == {"accounts.find": 2}
+
+def test_a_write_forces_a_re_read(app, sheets):
+    _, spreadsheet, ids = sheets
+    accounts_ws = spreadsheet.worksheet("accounts")
+    new_id = str(max(map(int, ids)) + 1)
+    with app.rerun_scope():
+        assert app.find_account_by_id(accounts_ws, new_id) is None
+        assert app.create_account(accounts_ws, new_id, "Cache Test", "AXA", "agent1", "Cairo",
+                                  False, "01000000000", "agent1")
+        spreadsheet.stats.reset()
+        assert app.find_account_by_id(accounts_ws, new_id) is not None
+        assert spreadsheet.stats.snapshot() == {"accounts.find": 1}
+
+def test_writes_to_another_table_keep_cached_reads(app, sheets):
+    _, spreadsheet, ids = sheets
+    accounts_ws = spreadsheet.worksheet("accounts")
+    with app.rerun_scope():
+        app.find_account_by_id(accounts_ws, ids[0])
+        app.invalidate_reads("transactions")
+        spreadsheet.stats.reset()
+        app.find_account_by_id(accounts_ws, ids[0])
+        assert spreadsheet.stats.snapshot() == {}
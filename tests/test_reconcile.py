@@ -0,0 +1,55 @@
+# coding: utf-8
+
+# Ledger reconciliation (compute_ledger_balances, reconcile_ledger).
+
+
+def typed(app, table_name, header, rows):
+    return app.parse_typed_rows(header, rows, app.TABLE_SCHEMAS[table_name])
+
+def accounts(app, *rows):
+    return typed(app, "accounts", ["ID", "CanHaveNegativeBalance"], rows)
+
+def transactions(app, *rows):
+    return typed(app, "transactions", ["ID", "TransactionType", "Amount"], rows)
+
+def balances(app, *rows):
+    return typed(app, "user_balances", ["id", "balance"], rows)
+
+def problems(report):
+    return {row.ID: (row.Difference, row.Mismatch, row.NegativeNotAllowed) for row in report.itertuples()}
+
+def test_matching_balances_are_not_reported(app):
+    report = app.reconcile_balances(
+        accounts(app, [1, "False"], [2, "True"]),
+        transactions(app, [1, "ADD", "100"], [1, "DEDUCT", "40.5"], [2, "DEDUCT", "10"]),
+        balances(app, [1, "59.5"], [2, "-10"]))
+    assert report.empty
+
+def test_a_mismatch_is_flagged(app):
+    report = app.reconcile_balances(
+        accounts(app, [1, "False"], [2, "False"], [3, "False"]),
+        transactions(app, [1, "ADD", "100"], [2, "ADD", "5"]),
+        balances(app, [1, "90"], [2, "5"], [3, "1"]))
+    # 1 differs by 10 EGP, 2 matches, 3 has a balance row but no transactions
+    assert problems(report) == {1: (1000, True, False), 3: (-100, True, False)}
+
+def test_a_missing_balance_row_is_flagged(app):
+    report = app.reconcile_balances(
+        accounts(app, [1, "False"]), transactions(app, [1, "ADD", "3"]), balances(app))
+    assert problems(report) == {1: (300, True, False)}
+    assert not report["HasBalanceRow"].any()
+
+def test_negative_not_allowed_is_flagged(app):
+    report = app.reconcile_balances(
+        accounts(app, [1, "False"], [2, "True"]),
+        transactions(app, [1, "DEDUCT", "20"], [2, "DEDUCT", "20"]),
+        balances(app, [1, "-20"], [2, "-20"]))
+    # Both balances match; only account 1 may not go negative
+    assert problems(report) == {1: (0, False, True)}
+
+def test_streamed_ledger_matches_the_full_table(app, sheets):
+    _, spreadsheet, _ = sheets
+    ws = spreadsheet.worksheet("transactions")
+    streamed = app.accumulate_ledger_balances(app.iter_typed_chunks(ws, "transactions", chunk_rows=37))
+    full = app.compute_ledger_balances(app.load_typed_table(ws, "transactions"))
+    assert streamed.sort_index().equals(full.sort_index())
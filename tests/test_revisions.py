@@ -0,0 +1,166 @@
+# coding: utf-8
+
+# Conditional reloads (ConditionalTableLoader) against a local stand-in for
+# the Drive "files" metadata endpoint.
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+
+class DriveStub:
+    """
+    Serves GET /files/<id> with the revision in self.revisions[id].
+    """
+
+    def __init__(self):
+        self.revisions = {}
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                spreadsheet_id = self.path.split("?")[0].rsplit("/", 1)[-1]
+                stub.requests.append(self.path)
+                revision = stub.revisions.get(spreadsheet_id)
+                if revision is None:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = json.dumps({"modifiedTime": f"2026-01-01T00:00:{revision:02d}Z",
+                                   "version": str(revision)}).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/files"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+@pytest.fixture
+def drive():
+    stub = DriveStub()
+    yield stub
+    stub.close()
+
+def make_loader(app, drive, client):
+    session = requests.Session()
+
+    def fetch_revision(_client, spreadsheet_id):
+        return app.fetch_spreadsheet_revision(session, spreadsheet_id, files_url=drive.url)
+
+    return app.ConditionalTableLoader(client_factory=lambda: client, fetch_revision=fetch_revision,
+                                      shard_map=app.load_shard_map(""))
+
+def data_reads(stats):
+    return {name: count for name, count in stats.calls.items() if name.split(".")[-1] in
+            ("get_values", "batch_get", "get_all_records", "get_all_values")}
+
+def test_unchanged_revision_reuses_tables(app, drive, sheets):
+    client, spreadsheet, _ = sheets
+    drive.revisions[spreadsheet.id] = 1
+    loader = make_loader(app, drive, client)
+
+    tables = loader()
+    assert loader.full_loads == 1
+    client.stats.reset()
+
+    assert loader() is tables
+    assert loader.skipped_loads == 1
+    assert data_reads(client.stats) == {}
+    assert len(drive.requests) == 2
+    assert "fields=modifiedTime%2Cversion" in drive.requests[-1]
+
+def append_transactions(spreadsheet, count, user_id="29000000000001"):
+    ws = spreadsheet.worksheet("transactions")
+    for i in range(count):
+        ws.append_row([f"2026-01-02 10:00:{i % 60:02d}", user_id, "ADD", 5, "Nasser", "agent1", "", ""])
+
+def assert_same_tables(app, tables, client):
+    fresh = make_fresh_loader(app, client)()
+    for name in app.READ_MODEL_TABLES:
+        assert tables[name].astype(str).reset_index(drop=True).equals(
+            fresh[name].astype(str).reset_index(drop=True)), name
+
+def make_fresh_loader(app, client):
+    return app.ConditionalTableLoader(client_factory=lambda: client, fetch_revision=lambda *args: None,
+                                      shard_map=app.load_shard_map(""))
+
+def test_appended_transactions_are_read_incrementally(app, drive, sheets):
+    client, spreadsheet, _ = sheets
+    drive.revisions[spreadsheet.id] = 1
+    loader = make_loader(app, drive, client)
+    tables = loader()
+
+    append_transactions(spreadsheet, 3)
+    drive.revisions[spreadsheet.id] = 2
+    client.stats.reset()
+
+    reloaded = loader()
+    assert reloaded is not tables
+    assert (loader.full_loads, loader.incremental_loads, loader.skipped_loads) == (1, 1, 0)
+    assert len(reloaded["transactions"]) == len(tables["transactions"]) + 3
+    # One probe for every table, then only the derived balances are re-read
+    assert set(data_reads(client.stats)) == {"user_balances.get_values"}
+    assert client.stats.calls["spreadsheet.values_batch_get"] == 1
+    assert_same_tables(app, reloaded, client)
+
+def test_appends_longer_than_the_probe_are_streamed(app, sheets, monkeypatch):
+    client, spreadsheet, _ = sheets
+    monkeypatch.setattr(app, "APPEND_PROBE_ROWS", 3)
+    loader = make_fresh_loader(app, client)
+    loader()
+
+    append_transactions(spreadsheet, 10)
+    assert_same_tables(app, loader(), client)
+    assert loader.incremental_loads == 1
+
+def test_changed_last_row_and_local_writes_reload_the_table(app, sheets):
+    client, spreadsheet, ids = sheets
+    loader = make_fresh_loader(app, client)
+    loader()
+    accounts = spreadsheet.worksheet("accounts")
+
+    accounts.update_cell(len(ids) + 1, 2, "Renamed by hand")  # the last row
+    client.stats.reset()
+    tables = loader()
+    assert tables["accounts"]["Name"].iloc[-1] == "Renamed by hand"
+    assert "accounts.get_values" in data_reads(client.stats)
+
+    accounts.update_cell(2, 2, "Renamed by this process")  # mid-sheet: invisible to the probe
+    app.invalidate_reads("accounts")
+    tables = loader()
+    assert tables["accounts"]["Name"].iloc[0] == "Renamed by this process"
+    assert_same_tables(app, tables, client)
+
+def test_unchanged_tables_are_not_read(app, sheets):
+    client, _, _ = sheets
+    loader = make_fresh_loader(app, client)
+    tables = loader()
+    client.stats.reset()
+
+    assert loader() is tables
+    assert data_reads(client.stats) == {}
+
+def test_tables_are_fully_reloaded_periodically(app, sheets, monkeypatch):
+    client, spreadsheet, _ = sheets
+    loader = make_fresh_loader(app, client)
+    loader()
+
+    spreadsheet.worksheet("users").update_cell(2, 3, "false")  # mid-sheet edit elsewhere
+    monkeypatch.setattr(app, "READ_MODEL_FULL_RELOAD_SECONDS", 0)
+    tables = loader()
+    assert loader.full_loads == 2
+    assert not tables["users"]["negative_access"].iloc[0]
@@ -0,0 +1,75 @@
+# coding: utf-8
+
+# Branch shards (ShardRouter, combine_shard_tables, sum_shard_balances).
+
+import pytest
+
+from fakesheets import FakeClient, seed_shard
+
+
+@pytest.fixture
+def sharded(app, sheets):
+    """
+    An AccountService whose Suez transactions go to 'database_suez':
+    (service, home spreadsheet, shard spreadsheet, account IDs).
+    """
+    client, spreadsheet, ids = sheets
+    shard = seed_shard("database_suez", spreadsheet.stats)
+    client = FakeClient([spreadsheet, shard], spreadsheet.stats)
+    shard_map = app.load_shard_map("Suez=database_suez")
+    read_model = app.SharedReadModel(app.ConditionalTableLoader(
+        client_factory=lambda: client, fetch_revision=lambda *args: None, shard_map=shard_map))
+    service = app.AccountService(app.open_backend(client, shard_map=shard_map), read_model,
+                                 alert_engine=app.AlertEngine(log_path=""))
+    return service, spreadsheet, shard, ids
+
+def test_writes_go_to_the_branch_shard(sharded):
+    service, home, shard, ids = sharded
+    home_rows = len(home.worksheet("transactions").get_all_values())
+
+    service.record_transaction(ids[0], "ADD", 50, "Suez", "agent1")
+    service.record_transaction(ids[0], "ADD", 7, "Nasser", "agent1")
+
+    shard_rows = shard.worksheet("transactions").get_all_values()[1:]
+    assert [(row[1], row[4]) for row in shard_rows] == [(ids[0], "Suez")]
+    assert len(home.worksheet("transactions").get_all_values()) == home_rows + 1
+
+def test_history_and_balances_merge_every_shard(app, sharded):
+    service, home, shard, ids = sharded
+    user_id = ids[1]
+    balance = service.get_balance(user_id)
+    history = len(service.get_history(user_id))
+
+    service.record_transaction(user_id, "ADD", 50, "Suez", "agent1")
+    service.read_model.refresh()  # what the poller does after request_refresh()
+
+    assert service.get_balance(user_id) == pytest.approx(balance + 50)
+    df_history = service.get_history(user_id)
+    assert len(df_history) == history + 1
+    assert df_history.iloc[0]["Branch"] == "Suez"  # latest first
+    tables = service.read_model.snapshot().tables
+    assert app.lookup_balance(tables["user_balances"], user_id) == round((balance + 50) * 100)
+
+def test_combined_transactions_are_in_time_order(app):
+    def transactions(*stamps):
+        rows = [[stamp, 1, "ADD", "1", "Cairo", "agent1", "", ""] for stamp in stamps]
+        return app.parse_typed_rows(list(app.TABLE_SCHEMAS["transactions"]), rows, app.TABLE_SCHEMAS["transactions"])
+
+    def balances(*rows):
+        return app.parse_typed_rows(["id", "balance"], rows, app.TABLE_SCHEMAS["user_balances"])
+
+    home = {"transactions": transactions("2026-01-01 10:00:00", "2026-01-03 10:00:00"),
+            "user_balances": balances([1, "5"]), "accounts": "home only"}
+    suez = {"transactions": transactions("2026-01-02 10:00:00"),
+            "user_balances": balances([1, "2"], [2, "3"])}
+    tables = app.combine_shard_tables([home, suez])
+    assert tables["accounts"] == "home only"
+    assert tables["transactions"]["Timestamp"].dt.day.tolist() == [1, 2, 3]
+    assert dict(zip(tables["user_balances"]["id"], tables["user_balances"]["balance"])) == {1: 700, 2: 300}
+
+def test_only_the_first_balance_row_of_a_shard_counts(app):
+    def balances(*rows):
+        return app.parse_typed_rows(["id", "balance"], rows, app.TABLE_SCHEMAS["user_balances"])
+
+    df = app.sum_shard_balances([balances([1, "5"], [1, "100"]), balances([1, "1"])])
+    assert df["balance"].tolist() == [600]
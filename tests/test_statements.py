@@ -0,0 +1,51 @@
+# coding: utf-8
+
+# Batch statement generation (build_company_statements, write_statements_zip
+# and the renderers in statements.py).
+
+import io
+import zipfile
+
+import pytest
+
+import statements
+
+
+def make_statement(i, name="Customer"):
+    return {"id": str(29000000000000 + i), "name": name, "company": "بنك مصر", "branch": "Nasser",
+            "period_start": "2026-01-01", "period_end": "2026-01-31", "opening_balance": 10.0,
+            "closing_balance": 15.0, "transactions": [("2026-01-02 10:00:00", "ADD", 5.0, "Nasser", "agent1")]}
+
+def test_process_pool_writes_every_statement(app):
+    count = app.STATEMENT_POOL_THRESHOLD + 10  # large enough to use the (spawned) process pool
+    target = io.BytesIO()
+
+    assert app.write_statements_zip([make_statement(i) for i in range(count)], target, "csv", workers=2) == count
+    with zipfile.ZipFile(target) as archive:
+        names = archive.namelist()
+    assert len(names) == count + 1 and "summary.csv" in names
+
+def test_pdf_is_offered_only_with_its_packages(monkeypatch):
+    monkeypatch.setattr(statements, "PDF_PACKAGES", ("reportlab", "a_package_that_is_not_installed"))
+    assert not statements.pdf_available()
+
+def test_pdf_text_shapes_arabic_only():
+    pytest.importorskip("arabic_reshaper")
+    pytest.importorskip("bidi")
+
+    assert statements.pdf_text("AXA") == "AXA"
+    # بنك: initial beh, medial noon, final kaf, in visual (right-to-left) order
+    assert statements.pdf_text("بنك") == "\uFEDA\uFEE8\uFE91"
+
+def test_pdf_statement_embeds_the_arabic_font():
+    pytest.importorskip("reportlab")
+    pytest.importorskip("arabic_reshaper")
+    pytest.importorskip("bidi")
+    try:
+        statements.pdf_font()
+    except RuntimeError as e:
+        pytest.skip(str(e))
+
+    pdf = statements.render_statement_pdf(make_statement(1, name="فاطمة أحمد"))
+    # reportlab embeds a subset of the TrueType file under the font's own name
+    assert pdf.startswith(b"%PDF") and b"/FontFile2" in pdf
@@ -0,0 +1,24 @@
+# coding: utf-8
+
+# Typed columns parsed from raw sheet values (_coerce_column, parse_typed_table).
+
+
+def test_amounts_coerce_to_piastres(app):
+    values = ["12.5", "1,234.56", " 7 ", "", None, "n/a", 0.1 + 0.2, 19.99, "-3,000"]
+    series = app._coerce_column(values, "piastres")
+    assert str(series.dtype) == "int64"
+    assert series.tolist() == [1250, 123456, 700, 0, 0, 0, 30, 1999, -300000]
+
+def test_blank_ids_coerce_to_missing(app):
+    series = app._coerce_column(["29000000000001", 42, "", " 7 ", "abc"], "id")
+    assert series.tolist() == [29000000000001, 42, app.MISSING_ID, 7, app.MISSING_ID]
+
+def test_timestamps_and_flags(app):
+    stamps = app._coerce_column(["2026-01-02 03:04:05", "", "yesterday"], "timestamp")
+    assert stamps.iloc[0].day == 2 and stamps.iloc[1:].isna().all()
+    assert app._coerce_column(["TRUE", "False", "", "yes"], "bool").tolist() == [True, False, False, False]
+
+def test_records_missing_columns_are_filled(app):
+    df = app.parse_typed_table([{"id": "5", "balance": "1,000"}, {"id": ""}], app.TABLE_SCHEMAS["user_balances"])
+    assert df["id"].tolist() == [5, app.MISSING_ID]
+    assert df["balance"].tolist() == [100000, 0]